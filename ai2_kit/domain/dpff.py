@@ -8,7 +8,7 @@ import os
 import re
 
 
-from .dplr import set_dplr_ext_from_cp2k_output, get_sel_ids
+from .dplr import set_dplr_ext_from_cp2k_output, get_sel_ids, read_cp2k_output
 from ai2_kit.core.log import get_logger
 
 logger = get_logger(__name__)
@@ -56,7 +56,7 @@ def dpdata_read_cp2k_dpff_data(
     wannier_spread_file = (
         os.path.join(cp2k_dir, wannier_spread_file) if wannier_spread_file else None
     )
-    dp_sys = dpdata.LabeledSystem(cp2k_output, fmt="cp2k/output")
+    dp_sys = read_cp2k_output(cp2k_output)
     try:
         dp_sys = set_dpff_ext_from_cp2k_output(
             dp_sys,
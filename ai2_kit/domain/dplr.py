@@ -1,6 +1,7 @@
 from typing import List, Optional
+from functools import lru_cache
 
-from ase.geometry.cell import cell_to_cellpar
+from ase.geometry.cell import cell_to_cellpar, cellpar_to_cell
 from ase import Atoms
 import numpy as np
 
@@ -8,12 +9,16 @@ import ase.io
 import dpdata
 import os
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 from .util import LammpsData
 from ai2_kit.core.log import get_logger
 
 logger = get_logger(__name__)
 
+# use numba kernel when the number of atom-wannier pairs exceeds this value
+NUMBA_PAIRS_THRESHOLD = 1_000_000
+
 
 def dpdata_read_cp2k_dplr_data(
     cp2k_dir: str,
@@ -25,6 +30,7 @@ def dpdata_read_cp2k_dplr_data(
     wannier_spread_file: Optional[str] = None,
     model_charge_map: Optional[List[int]] = None,
     export_atomic_weight: bool = False,
+    n_jobs: int = 1,
 ):
     """
     Gnereate dpdata from cp2k output and wannier file for DPLR
@@ -38,6 +44,7 @@ def dpdata_read_cp2k_dplr_data(
     :param wannier_spread_file: the wannier spread file, if provided, the spread data will be added to dp_sys
     :param model_charge_map: the charge map of wannier in model, for example, [-8]
     :param export_atomic_weight: whether to export atomic weight rather than return None when getting exception
+    :param n_jobs: the number of threads to process frames, -1 means using all cpus
 
     :return dp_sys: dpdata.LabeledSystem
         In addition to the common energy data, atomic_dipole data is added.
@@ -55,7 +62,7 @@ def dpdata_read_cp2k_dplr_data(
     wannier_spread_file = (
         os.path.join(cp2k_dir, wannier_spread_file) if wannier_spread_file else None
     )
-    dp_sys = dpdata.LabeledSystem(cp2k_output, fmt="cp2k/output")
+    dp_sys = read_cp2k_output(cp2k_output)
     try:
         dp_sys = set_dplr_ext_from_cp2k_output(
             dp_sys,
@@ -66,6 +73,7 @@ def dpdata_read_cp2k_dplr_data(
             wannier_spread_file,
             model_charge_map,
             export_atomic_weight,
+            n_jobs,
         )
     except:
         dp_sys = None
@@ -73,6 +81,27 @@ def dpdata_read_cp2k_dplr_data(
     return dp_sys
 
 
+def read_cp2k_output(cp2k_output: str) -> dpdata.LabeledSystem:
+    """
+    Read cp2k output as dpdata.LabeledSystem
+
+    The parsed system is cached by path, modification time and size,
+    a copy is returned so that it is safe to modify.
+
+    :param cp2k_output: the cp2k output file
+    """
+    stat = os.stat(cp2k_output)
+    dp_sys = _read_cp2k_output(
+        os.path.abspath(cp2k_output), stat.st_mtime_ns, stat.st_size
+    )
+    return dp_sys.copy()
+
+
+@lru_cache(maxsize=16)
+def _read_cp2k_output(path: str, mtime_ns: int, size: int):
+    return dpdata.LabeledSystem(path, fmt="cp2k/output")
+
+
 def set_dplr_ext_from_cp2k_output(
     dp_sys: dpdata.LabeledSystem,
     wannier_file: str,
@@ -82,19 +111,25 @@ def set_dplr_ext_from_cp2k_output(
     wannier_spread_file: Optional[str] = None,
     model_charge_map: Optional[List[int]] = None,
     export_atomic_weight: bool = False,
+    n_jobs: int = 1,
 ):
-    wannier_atoms = ase.io.read(wannier_file)
-    # assert np.all(wannier_atoms.symbols == "X"), (
-    #     "%s should include Wannier centres only" % wannier_file
-    # )
-    mask = wannier_atoms.symbols == "X"  # type: ignore
-    wannier_atoms = wannier_atoms[mask]
-
     natoms = dp_sys.get_natoms()
     nframes = dp_sys.get_nframes()
     if nframes == 0:
         return None
-    assert nframes == 1, "Only support one frame"
+
+    # the last frames of wannier file are aligned with the frames of dp_sys
+    wannier_frames = ase.io.read(wannier_file, index=f"-{nframes}:")
+    if len(wannier_frames) < nframes:  # type: ignore
+        raise ValueError(
+            f"{wannier_file} has {len(wannier_frames)} frames, expect {nframes}"  # type: ignore
+        )
+    # assert np.all(wannier_atoms.symbols == "X"), (
+    #     "%s should include Wannier centres only" % wannier_file
+    # )
+    wannier_frames = [
+        atoms[atoms.symbols == "X"] for atoms in wannier_frames  # type: ignore
+    ]
 
     if export_atomic_weight:
         dp_sys.data["atomic_weight"] = np.ones([nframes, natoms, 1])
@@ -105,13 +140,14 @@ def set_dplr_ext_from_cp2k_output(
     atomic_dipole, extended_coords, wannier_spread = get_atomic_dipole(
         dp_sys,
         sel_ids,
-        wannier_atoms,
+        wannier_frames,
         wannier_cutoff,
         wannier_spread_file,
         cns_ref,
+        n_jobs,
     )
     atomic_dipole_reformat = np.zeros((nframes, natoms, 3))
-    atomic_dipole_reformat[:, sel_ids, :] = atomic_dipole.reshape([nframes, -1, 3])
+    atomic_dipole_reformat[:, sel_ids, :] = atomic_dipole
     atomic_dipole = atomic_dipole_reformat
     dp_sys.data["atomic_dipole"] = atomic_dipole.reshape([nframes, natoms, 3])
     try:
@@ -130,9 +166,10 @@ def set_dplr_ext_from_cp2k_output(
 
 
 def get_sel_ids(dp_sys, type_map, sel_type):
-    symbols = np.array(dp_sys.data["atom_names"])[dp_sys.data["atom_types"]]
-    # sel_ids = [np.where(symbols == type_map[ii])[0] for ii in sel_type]
-    sel_ids = np.where(np.isin(symbols, np.array(type_map)[sel_type]))[0]
+    # sel_type refers to type_map, whose order may differ from atom_names of dp_sys
+    sel_symbols = np.array(type_map)[sel_type]
+    sel_mask_by_type = np.isin(dp_sys.data["atom_names"], sel_symbols)
+    sel_ids = np.flatnonzero(sel_mask_by_type[dp_sys.data["atom_types"]])
     return sel_ids
 
 
@@ -157,58 +194,364 @@ def get_atomic_dipole(
     wannier_cutoff=1.0,
     wannier_spread_file=None,
     cns_ref=None,
+    n_jobs=1,
 ):
-    from MDAnalysis.lib.distances import distance_array, minimize_vectors
+    """
+    Get atomic dipole of selected atoms from wannier centers
 
-    coords = dp_sys.data["coords"].reshape(-1, 3)
-    cellpar = cell_to_cellpar(dp_sys.data["cells"].reshape(3, 3))
-    extended_coords = coords.copy()
+    :param dp_sys: dpdata.LabeledSystem
+    :param sel_ids: indices of selected atoms
+    :param wannier_atoms: wannier centers of each frame, a single Atoms is accepted for one frame
+    :param wannier_cutoff: the cutoff to allocate wannier centers around atoms
+    :param wannier_spread_file: the wannier spread file, only supported for one frame
+    :param cns_ref: the expected number of wannier centers of each selected atom, default is 4
+    :param n_jobs: the number of threads to process frames, -1 means using all cpus
+
+    :return atomic_dipole: shape (nframes, nsel, 3)
+    :return extended_coords: coordinates of atoms and wannier centroids, shape (nframes, natoms + nsel, 3)
+    :return wannier_spread: spread of wannier centers of the selected atoms, shape (nsel, 4),
+        empty if wannier_spread_file is not provided
+    """
+    if isinstance(wannier_atoms, Atoms):
+        wannier_atoms = [wannier_atoms]
+    nframes = dp_sys.get_nframes()
+    assert len(wannier_atoms) == nframes, "wannier_atoms should match the frames"
+
+    coords = dp_sys.data["coords"].reshape(nframes, -1, 3)
+    cells = dp_sys.data["cells"].reshape(nframes, 3, 3)
+    # compute cellpar once if the cell is constant, e.g. NVT trajectories
+    if np.all(cells == cells[0]):
+        cellpars = [cell_to_cellpar(cells[0])] * nframes
+    else:
+        cellpars = [cell_to_cellpar(cell) for cell in cells]
 
     if wannier_spread_file:
+        assert nframes == 1, "wannier_spread_file only supports one frame"
         full_wannier_spread = read_wannier_spread(wannier_spread_file)[:, -1]
     else:
         full_wannier_spread = None
 
     export_atomic_weight = "atomic_weight" in dp_sys.data
-
-    ref_coords = coords[sel_ids].reshape(-1, 3)
-    e_coords = wannier_atoms.get_positions()
-    dist_mat = distance_array(ref_coords, e_coords, box=cellpar)
-    atomic_dipole = []
-    wannier_spread = []
-    mlwc_ids = []
     if cns_ref is None:
-        cns_ref = [4] * len(sel_ids)
-    for ii, dist_vec in enumerate(dist_mat):
-        mask = dist_vec < wannier_cutoff
-        cn = np.sum(mask)
-        if cn != cns_ref[ii]:
+        cns_ref = np.full(len(sel_ids), 4)
+
+    natoms = coords.shape[1]
+    ref_coords = coords[:, sel_ids].reshape(nframes, -1, 3)
+    atomic_dipole = np.empty((nframes, len(sel_ids), 3), dtype=coords.dtype)
+    extended_coords = np.empty(
+        (nframes, natoms + len(sel_ids), 3), dtype=coords.dtype
+    )
+    extended_coords[:, :natoms] = coords
+
+    # frames are independent, and the heavy work in each frame releases the GIL
+    use_threads = n_jobs != 1 and nframes > 1
+
+    def process_frame(ii):
+        cellpar = cellpars[ii]
+        e_coords = wannier_atoms[ii].get_positions()
+        # the numba kernel is parallel already,
+        # and launching it from threads is not safe with some threading layers
+        atomic_dipole[ii], idx, mask = get_frame_atomic_dipole(
+            ref_coords[ii],
+            e_coords,
+            cellpar,
+            wannier_cutoff,
+            use_numba=not use_threads,
+        )
+        extended_coords[ii, natoms:] = ref_coords[ii] + atomic_dipole[ii]
+        return idx, mask
+
+    if not use_threads:
+        neighbors = [process_frame(ii) for ii in range(nframes)]
+    else:
+        max_workers = None if n_jobs < 0 else n_jobs
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            neighbors = list(executor.map(process_frame, range(nframes)))
+
+    for ii, (idx, mask) in enumerate(neighbors):
+        cns = np.sum(mask, axis=1)
+        bad_ids = np.flatnonzero(cns != cns_ref)
+        if len(bad_ids) > 0:
             if not export_atomic_weight:
+                jj = bad_ids[0]
                 raise ValueError(
-                    f"wannier atoms {ii} has {cn} atoms in the cutoff range"
+                    f"wannier atoms {jj} has {cns[jj]} atoms "
+                    f"in the cutoff range of frame {ii}"
                 )
-            dp_sys.data["atomic_weight"][0, sel_ids[ii], 0] = 0
-        mlwc_ids.append(np.where(mask)[0])
-        wc_coord_rel = e_coords[mask] - ref_coords[ii]
-        if full_wannier_spread is not None:
-            wannier_spread.append(full_wannier_spread[mask])
-        wc_coord_rel = minimize_vectors(wc_coord_rel, box=cellpar)
-        _atomic_dipole = wc_coord_rel.mean(axis=0)
-        atomic_dipole.append(_atomic_dipole)
-        wc_coord = _atomic_dipole + ref_coords[ii]
-        extended_coords = np.concatenate(
-            (extended_coords, wc_coord.reshape(1, 3)), axis=0
-        )
-    mlwc_ids = np.concatenate(mlwc_ids)
-    # exclude double counting
-    assert len(np.unique(mlwc_ids)) == len(mlwc_ids)
-    atomic_dipole = np.reshape(atomic_dipole, (-1, 3))
-    assert atomic_dipole.shape[0] == len(sel_ids)
+            dp_sys.data["atomic_weight"][ii, sel_ids[bad_ids], 0] = 0
+
+        mlwc_ids = idx[mask]
+        # exclude double counting
+        assert not np.any(np.diff(np.sort(mlwc_ids)) == 0)
+
     if full_wannier_spread is not None:
-        wannier_spread = np.concatenate(wannier_spread)
+        wannier_spread = full_wannier_spread[mlwc_ids].reshape(len(sel_ids), -1)
+    else:
+        wannier_spread = np.empty((0, 4))
     return atomic_dipole, extended_coords, wannier_spread
 
 
+def get_frame_atomic_dipole(
+    ref_coords, e_coords, cellpar, wannier_cutoff=1.0, use_numba=True
+):
+    """
+    Get atomic dipole of reference atoms in a single frame
+
+    The atomic dipole is the mean of the relative positions of
+    the wannier centers within the cutoff of each reference atom.
+
+    :param ref_coords: coordinates of reference atoms, shape (nref, 3)
+    :param e_coords: coordinates of wannier centers, shape (nwc, 3)
+    :param cellpar: the cell parameters [a, b, c, alpha, beta, gamma]
+    :param wannier_cutoff: the cutoff to allocate wannier centers around atoms
+    :param use_numba: whether to use the numba kernel for large systems
+
+    :return atomic_dipole: shape (nref, 3)
+    :return idx: indices of wannier centers, see get_wannier_neighbors
+    :return mask: whether the wannier center is within the cutoff, see get_wannier_neighbors
+    """
+    idx, mask = get_wannier_neighbors(
+        ref_coords, e_coords, cellpar, wannier_cutoff, use_numba
+    )
+    if len(e_coords) == 0:
+        atomic_dipole = np.full((len(ref_coords), 3), np.nan)
+        return atomic_dipole, idx, mask
+    wc_coord_rel = e_coords[idx] - ref_coords[:, None, :]
+    wc_coord_rel = minimize_vectors(wc_coord_rel.reshape(-1, 3), cellpar)
+    wc_coord_rel = wc_coord_rel.reshape(idx.shape + (3,))
+    # centers out of the cutoff range are excluded from the mean
+    cns = np.sum(mask, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        atomic_dipole = np.sum(wc_coord_rel * mask[..., None], axis=1) / cns[:, None]
+    return atomic_dipole, idx, mask
+
+
+def is_orthorhombic(cellpar):
+    return np.allclose(cellpar[3:], 90.0)
+
+
+def minimize_vectors(vectors, cellpar):
+    """
+    Apply the minimum image convention to vectors
+
+    :param vectors: vectors of shape (n, 3)
+    :param cellpar: the cell parameters [a, b, c, alpha, beta, gamma]
+    """
+    if is_orthorhombic(cellpar):
+        box = np.asarray(cellpar[:3])
+        return vectors - box * np.rint(vectors / box)
+    from MDAnalysis.lib.distances import minimize_vectors as _minimize_vectors
+
+    return _minimize_vectors(vectors, box=cellpar)
+
+
+def get_wannier_neighbors(
+    ref_coords, e_coords, cellpar, wannier_cutoff=1.0, use_numba=True
+):
+    """
+    Find the wannier centers within the cutoff of each reference atom
+
+    For large systems, a parallel numba kernel with cell list is used if numba
+    is installed. Otherwise a periodic cKDTree is used for orthorhombic cells,
+    and the full distance matrix is computed for triclinic cells.
+
+    :param ref_coords: coordinates of reference atoms, shape (nref, 3)
+    :param e_coords: coordinates of wannier centers, shape (nwc, 3)
+    :param cellpar: the cell parameters [a, b, c, alpha, beta, gamma]
+    :param wannier_cutoff: the cutoff to allocate wannier centers around atoms
+    :param use_numba: whether to use the numba kernel for large systems
+
+    :return idx: indices of wannier centers of each reference atom in ascending order, shape (nref, k)
+    :return mask: whether the wannier center is within the cutoff, shape (nref, k),
+        the centers within the cutoff always come first
+    """
+    if len(e_coords) == 0:
+        idx = np.zeros((len(ref_coords), 1), dtype=int)
+        mask = np.zeros((len(ref_coords), 1), dtype=bool)
+        return idx, mask
+
+    use_numba = (
+        use_numba
+        and len(ref_coords) * len(e_coords) > NUMBA_PAIRS_THRESHOLD
+        and _get_numba_kernel() is not None
+    )
+    if use_numba:
+        neighbors = get_wannier_neighbors_numba(
+            ref_coords, e_coords, cellpar, wannier_cutoff
+        )
+        if neighbors is not None:
+            return neighbors
+
+    if is_orthorhombic(cellpar):
+        from scipy.spatial import cKDTree
+
+        box = np.asarray(cellpar[:3])
+        tree = cKDTree(wrap_positions(e_coords, box), boxsize=box)
+        ref_coords = wrap_positions(ref_coords, box)
+        # the max number of centers in the cutoff range is the k to query
+        cns = tree.query_ball_point(
+            ref_coords, r=wannier_cutoff, return_length=True, workers=-1
+        )
+        k = max(np.max(cns, initial=0), 1)
+        dists, idx = tree.query(
+            ref_coords, k=k, distance_upper_bound=wannier_cutoff, workers=-1
+        )
+        dists = dists.reshape(len(ref_coords), k)
+        idx = idx.reshape(len(ref_coords), k)
+    else:
+        from MDAnalysis.lib.distances import distance_array
+
+        dist_mat = distance_array(ref_coords, e_coords, box=cellpar)
+        cns = np.sum(dist_mat < wannier_cutoff, axis=1)
+        k = max(np.max(cns, initial=0), 1)
+        idx = np.argpartition(dist_mat, k - 1, axis=1)[:, :k]
+        dists = np.take_along_axis(dist_mat, idx, axis=1)
+
+    # sort by index so that the order is the same as the wannier file,
+    # centers out of the cutoff range are moved to the end
+    mask = dists < wannier_cutoff
+    order = np.argsort(np.where(mask, idx, len(e_coords)), axis=1)
+    idx = np.take_along_axis(idx, order, axis=1)
+    mask = np.take_along_axis(mask, order, axis=1)
+    # missing neighbors are marked with index nwc by cKDTree
+    idx[~mask] = 0
+    return idx, mask
+
+
+def get_wannier_neighbors_numba(ref_coords, e_coords, cellpar, wannier_cutoff=1.0):
+    """
+    Find the wannier centers within the cutoff of each reference atom with numba
+
+    The output is the same as get_wannier_neighbors.
+    Return None if the cell is too small to build a cell list.
+    """
+    cell = cellpar_to_cell(cellpar)
+    ncells = get_cell_list_shape(cell, wannier_cutoff)
+    if np.any(ncells < 3):
+        return None
+    ref_coords, ref_grid = get_cell_grid(ref_coords, cell, ncells)
+    e_coords, e_grid = get_cell_grid(e_coords, cell, ncells)
+    # bucket wannier centers by cell
+    cell_ids = np.ravel_multi_index(e_grid.T, ncells)
+    order = np.argsort(cell_ids, kind="stable")
+    starts = np.searchsorted(cell_ids[order], np.arange(np.prod(ncells) + 1))
+
+    # 4 centers are expected for most atoms, retry with more on overflow
+    find_wannier_neighbors = _get_numba_kernel()
+    k = 8
+    while True:
+        idx, cns = find_wannier_neighbors(
+            ref_coords,
+            ref_grid,
+            e_coords,
+            cell,
+            wannier_cutoff,
+            k,
+            ncells,
+            order,
+            starts,
+        )
+        if np.max(cns, initial=0) <= k:
+            break
+        k = np.max(cns)
+    k = max(np.max(cns, initial=0), 1)
+    idx = idx[:, :k]
+    mask = np.arange(k) < cns[:, None]
+    return idx, mask
+
+
+def get_cell_list_shape(cell, cell_size):
+    """
+    Get the number of cells along each cell vector,
+    so that the distance between opposite faces of each cell is at least cell_size
+    """
+    volume = abs(np.linalg.det(cell))
+    areas = np.linalg.norm(np.cross(cell[[1, 2, 0]], cell[[2, 0, 1]]), axis=1)
+    return (volume / areas // cell_size).astype(np.int64)
+
+
+def get_cell_grid(positions, cell, ncells):
+    """
+    Wrap positions into the cell and locate them in the cell list
+
+    :return positions: the wrapped positions
+    :return grid: the cell list index along each cell vector
+    """
+    frac = np.linalg.solve(cell.T, np.asarray(positions, dtype=float).T).T
+    frac -= np.floor(frac)
+    grid = np.minimum((frac * ncells).astype(np.int64), ncells - 1)
+    return frac @ cell, grid
+
+
+@lru_cache(maxsize=None)
+def _get_numba_kernel():
+    """
+    Build the numba kernel to find wannier centers with cell list,
+    return None if numba is not installed
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _find_wannier_neighbors_numba(
+        ref_coords, ref_grid, e_coords, cell, cutoff, k, ncells, order, starts
+    ):
+        """
+        Scan the 27 neighbor cells of each reference atom for wannier centers
+
+        :return idx: indices of the first k centers in ascending order, shape (nref, k)
+        :return cns: number of centers in the cutoff range, may be larger than k
+        """
+        nref = ref_coords.shape[0]
+        idx = np.zeros((nref, k), dtype=np.int64)
+        cns = np.zeros(nref, dtype=np.int64)
+        cutoff2 = cutoff * cutoff
+        for i in numba.prange(nref):
+            n = 0
+            for ox in range(-1, 2):
+                gx = ref_grid[i, 0] + ox
+                sx = gx // ncells[0]
+                cx = gx - sx * ncells[0]
+                for oy in range(-1, 2):
+                    gy = ref_grid[i, 1] + oy
+                    sy = gy // ncells[1]
+                    cy = gy - sy * ncells[1]
+                    for oz in range(-1, 2):
+                        gz = ref_grid[i, 2] + oz
+                        sz = gz // ncells[2]
+                        cz = gz - sz * ncells[2]
+                        c = (cx * ncells[1] + cy) * ncells[2] + cz
+                        # the periodic image of the neighbor cell
+                        shift_x = sx * cell[0, 0] + sy * cell[1, 0] + sz * cell[2, 0]
+                        shift_y = sx * cell[0, 1] + sy * cell[1, 1] + sz * cell[2, 1]
+                        shift_z = sx * cell[0, 2] + sy * cell[1, 2] + sz * cell[2, 2]
+                        for jj in range(starts[c], starts[c + 1]):
+                            j = order[jj]
+                            dx = e_coords[j, 0] + shift_x - ref_coords[i, 0]
+                            dy = e_coords[j, 1] + shift_y - ref_coords[i, 1]
+                            dz = e_coords[j, 2] + shift_z - ref_coords[i, 2]
+                            if dx * dx + dy * dy + dz * dz < cutoff2:
+                                if n < k:
+                                    idx[i, n] = j
+                                n += 1
+            cns[i] = n
+            idx[i, : min(n, k)] = np.sort(idx[i, : min(n, k)])
+        return idx, cns
+
+    return _find_wannier_neighbors_numba
+
+
+def wrap_positions(positions, box):
+    """
+    Wrap positions into [0, box) of an orthorhombic cell
+    """
+    positions = np.mod(positions, box)
+    # np.mod may return box for tiny negative values
+    return np.where(positions >= box, positions - box, positions)
+
+
 def build_sel_type_assertion(sel_type, model_path: str, py_cmd="python"):
     return f'''{py_cmd} -c "from deepmd.infer import DeepDipole;dp = DeepDipole({repr(model_path)});assert{repr(sel_type)}==[t for t in dp.tselt]"'''
 
@@ -251,34 +594,40 @@ def dump_dplr_lammps_data(
     r_atom_ids = []
     v_atom_ids = []
 
+    # group atom indices by symbol once
+    symbols = np.asarray(atoms.get_chemical_symbols())
+    symbol_ids = {s: np.flatnonzero(symbols == s) for s in set(type_map)}
+
     # add virtual atoms
     for atype, vtype in zip(sel_type, vtypes):
         # create virtual atoms from the original atom type
-        v_atoms = atoms[atoms.symbols == type_map[atype]]
+        atom_ids = symbol_ids[type_map[atype]]
+        v_atoms = atoms[atom_ids]
         v_atoms.set_chemical_symbols([vtype] * len(v_atoms))  # type: ignore
 
         # create bonds between atom and its virtual atoms
-        r_atom_ids.extend(np.where(atoms.symbols == type_map[atype])[0])
-        v_atom_ids.extend(np.arange(len(v_atoms)) + len(new_atoms))  # type: ignore
+        r_atom_ids.append(atom_ids)
+        v_atom_ids.append(np.arange(len(v_atoms)) + len(new_atoms))  # type: ignore
         # this should be last
         new_atoms += v_atoms
 
     # build charges
-    charges = np.zeros(len(new_atoms))
-    for atype, charge in zip(type_map + vtypes, sys_charge_map + model_charge_map):
-        charges[new_atoms.symbols == atype] = charge
+    charge_map = dict(zip(type_map + vtypes, sys_charge_map + model_charge_map))
+    new_symbols, inverse = np.unique(
+        new_atoms.get_chemical_symbols(), return_inverse=True
+    )
+    charges = np.array([charge_map.get(s, 0.0) for s in new_symbols], dtype=float)
+    charges = charges[inverse]
     # build bonds
+    r_atom_ids = np.concatenate([np.empty(0, dtype=int)] + r_atom_ids)
+    v_atom_ids = np.concatenate([np.empty(0, dtype=int)] + v_atom_ids)
     n_bonds = len(r_atom_ids)
     # note: the index of lammps start from 1
-    bonds = np.array(
-        [
-            np.arange(n_bonds) + 1,  # bond id
-            [1] * n_bonds,  # bond type
-            np.array(r_atom_ids) + 1,  # bond left
-            np.array(v_atom_ids) + 1,  # bond right
-        ],
-        dtype=int,
-    ).T
+    bonds = np.empty((n_bonds, 4), dtype=int)
+    bonds[:, 0] = np.arange(1, n_bonds + 1)  # bond id
+    bonds[:, 1] = 1  # bond type
+    bonds[:, 2] = r_atom_ids + 1  # bond left
+    bonds[:, 3] = v_atom_ids + 1  # bond right
 
     # write lammps data
     lmp_data = LammpsData(new_atoms)
@@ -296,12 +645,13 @@ def get_unused_symbols(used_symbols: List[str], size: int):
     """
     from ase.data import chemical_symbols
 
+    used = set(used_symbols)
     unused_symbols = []
     for symbol in reversed(chemical_symbols):
-        if symbol not in used_symbols:
-            unused_symbols.append(symbol)
         if len(unused_symbols) == size:
             break
+        if symbol not in used:
+            unused_symbols.append(symbol)
     return unused_symbols
 
 
@@ -329,17 +679,12 @@ def read_wannier_spread(fname: str):
     wannier_spread : numpy array
         wannier spread data
     """
-    # skip 1, 2, and the last lines
-    # save the others as array
+    # the first line is the number of wannier centers,
+    # skip the second line and the last line (total spread)
     with open(fname, "r", encoding="UTF-8") as f:
-        lines = f.readlines()[2:-1]
-
-    wannier = []
-    for line in lines:
-        # line to array
-        line = line.strip().split()
-        wannier.append([float(line[1]), float(line[2])])
-    return np.array(wannier)
+        n_wannier = int(f.readline())
+        f.readline()
+        return np.loadtxt(f, usecols=(1, 2), max_rows=n_wannier, ndmin=2)
 
 
 def dplr_v2_to_v3(data_path: str, sel_symbol: list):
@@ -349,24 +694,19 @@ def dplr_v2_to_v3(data_path: str, sel_symbol: list):
         "wannier_spread.npy",
         "atomic_weight.npy",
     ]
+    # the type info is shared by all sets of the same system
+    type_info_cache = {}
     for atomic_data_fname in atomic_data_fnames:
         fnames = glob.glob(
             os.path.join(data_path, "**", atomic_data_fname), recursive=True
         )
         for fname in fnames:
-            type_map = np.loadtxt(
-                os.path.join(os.path.dirname(fname), "../type_map.raw"),
-                dtype=str,
-            )
-            atype = np.loadtxt(
-                os.path.join(os.path.dirname(fname), "../type.raw"),
-                dtype=int,
-            )
-            symbols = np.array(type_map)[atype]
-            sel_ids = np.where(np.isin(symbols, sel_symbol))[0]
-            n_atoms = len(atype)
+            sys_dir = os.path.normpath(os.path.join(os.path.dirname(fname), ".."))
+            if sys_dir not in type_info_cache:
+                type_info_cache[sys_dir] = get_raw_sel_ids(sys_dir, sel_symbol)
+            sel_ids, n_atoms = type_info_cache[sys_dir]
 
-            raw_data = np.load(fname)
+            raw_data = np.load(fname, mmap_mode="r")
             n_frames = raw_data.shape[0]
             try:
                 raw_data = np.reshape(raw_data, [n_frames, len(sel_ids), -1])
@@ -376,36 +716,61 @@ def dplr_v2_to_v3(data_path: str, sel_symbol: list):
                 continue
             n_dim = raw_data.shape[2]
 
-            full_data = np.zeros([n_frames, n_atoms, n_dim])
+            full_data = np.zeros([n_frames, n_atoms, n_dim], dtype=raw_data.dtype)
             full_data[:, sel_ids] = raw_data
+            # release the memmap before overwriting the file
+            del raw_data
             np.save(fname, full_data.reshape([n_frames, -1]))
 
 
-def dplr_v3_to_v2(data_path: str, sel_symbol: list):
+def get_raw_sel_ids(sys_dir: str, sel_symbol: list):
+    """
+    Get the indices of selected atoms and the number of atoms
+    from the type_map.raw and type.raw of a deepmd/npy system
+
+    :param sys_dir: the directory of the system
+    :param sel_symbol: the symbols of selected atoms
+
+    :return sel_ids: indices of selected atoms
+    :return n_atoms: number of atoms
+    """
+    type_map = np.loadtxt(os.path.join(sys_dir, "type_map.raw"), dtype=str, ndmin=1)
+    atype = np.loadtxt(os.path.join(sys_dir, "type.raw"), dtype=int, ndmin=1)
+    symbols = type_map[atype]
+    sel_ids = np.where(np.isin(symbols, sel_symbol))[0]
+    return sel_ids, len(atype)
+
+
+def dplr_v3_to_v2(data_path: str, sel_symbol: list, chunk_size: int = 1024):
+    """
+    Convert atomic data of DPLR from v3 (all atoms) to v2 (selected atoms only)
+
+    The data is processed in chunks of frames with memory map,
+    so that the memory usage is bounded regardless of the number of frames.
+
+    :param data_path: the path of deepmd/npy data
+    :param sel_symbol: the symbols of selected atoms
+    :param chunk_size: the number of frames to process at a time
+    """
     atomic_data_fnames = [
         "atomic_dipole.npy",
         "atomic_polarizability.npy",
         "wannier_spread.npy",
         "atomic_weight.npy",
     ]
+    # the type info is shared by all sets of the same system
+    type_info_cache = {}
     for atomic_data_fname in atomic_data_fnames:
         fnames = glob.glob(
             os.path.join(data_path, "**", atomic_data_fname), recursive=True
         )
         for fname in fnames:
-            type_map = np.loadtxt(
-                os.path.join(os.path.dirname(fname), "../type_map.raw"),
-                dtype=str,
-            )
-            atype = np.loadtxt(
-                os.path.join(os.path.dirname(fname), "../type.raw"),
-                dtype=int,
-            )
-            symbols = np.array(type_map)[atype]
-            sel_ids = np.where(np.isin(symbols, sel_symbol))[0]
-            n_atoms = len(atype)
+            sys_dir = os.path.normpath(os.path.join(os.path.dirname(fname), ".."))
+            if sys_dir not in type_info_cache:
+                type_info_cache[sys_dir] = get_raw_sel_ids(sys_dir, sel_symbol)
+            sel_ids, n_atoms = type_info_cache[sys_dir]
 
-            raw_data = np.load(fname)
+            raw_data = np.load(fname, mmap_mode="r")
             n_frames = raw_data.shape[0]
             try:
                 raw_data_reshape = raw_data.reshape([n_frames, n_atoms, -1])
@@ -413,4 +778,19 @@ def dplr_v3_to_v2(data_path: str, sel_symbol: list):
                 raw_data.reshape([n_frames, len(sel_ids), -1])
                 logger.info(f"Already in v2 format: %s" % fname)
                 continue
-            np.save(fname, raw_data_reshape[:, sel_ids].reshape([n_frames, -1]))
+            n_dim = raw_data_reshape.shape[2]
+
+            tmp_fname = fname + ".tmp"
+            out_data = np.lib.format.open_memmap(
+                tmp_fname,
+                mode="w+",
+                dtype=raw_data.dtype,
+                shape=(n_frames, len(sel_ids) * n_dim),
+            )
+            for ii in range(0, n_frames, chunk_size):
+                chunk = raw_data_reshape[ii : ii + chunk_size, sel_ids]
+                out_data[ii : ii + chunk_size] = chunk.reshape([len(chunk), -1])
+            out_data.flush()
+            # release the memmaps before replacing the file
+            del raw_data, raw_data_reshape, out_data
+            os.replace(tmp_fname, fname)
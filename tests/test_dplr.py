@@ -1,16 +1,28 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 import os
 import glob
+import importlib.util
 import shutil
 
 import unittest
+import tempfile
+from unittest import mock
 from pathlib import Path
 import numpy as np
+import dpdata
 from scipy import constants
-from ase import io
+from ase import io, Atoms
 from ase.geometry import cell_to_cellpar
 
-from ai2_kit.domain.dplr import dpdata_read_cp2k_dplr_data, get_sel_ids
+from ai2_kit.domain import dplr
+from ai2_kit.domain.dplr import (
+    dpdata_read_cp2k_dplr_data,
+    get_atomic_dipole,
+    get_sel_ids,
+    get_wannier_neighbors,
+    read_cp2k_output,
+    set_dplr_ext_from_cp2k_output,
+)
 from ai2_kit.domain.dpff import dpdata_read_cp2k_dpff_data
 from ai2_kit.tool.dpdata import DpdataTool
 
@@ -305,6 +317,16 @@ class TestDPLRZeroAtomicWeight(unittest.TestCase):
             self.data.data["atomic_weight"].reshape(-1)[sel_ids] == 0,
         )
 
+    def test_no_wannier_centers(self):
+        dp_sys = read_cp2k_output(os.path.join(self.cp2k_dir, self.cp2k_output))
+        dp_sys.data["atomic_weight"] = np.ones([1, dp_sys.get_natoms(), 1])
+        sel_ids = get_sel_ids(dp_sys, self.type_map, self.sel_type)
+
+        atomic_dipole, _, _ = get_atomic_dipole(dp_sys, sel_ids, Atoms())
+
+        self.assertTrue(np.all(np.isnan(atomic_dipole)))
+        np.testing.assert_array_equal(dp_sys.data["atomic_weight"][0, sel_ids], 0)
+
     def test_assertion(self):
         with self.assertRaises(AssertionError):
             dpdata_read_cp2k_dplr_data(
@@ -321,5 +343,137 @@ class TestDPLRZeroAtomicWeight(unittest.TestCase):
             )
 
 
+class TestDPLRMultiFrame(unittest.TestCase, CP2kTestData):
+    def setUp(self):
+        CP2kTestData.__init__(self)
+
+        self.data = dpdata_read_cp2k_dplr_data(
+            self.cp2k_dir,
+            self.cp2k_output,
+            self.wannier_file,
+            self.type_map,
+            self.sel_type,
+        )
+
+    def test_consistent(self):
+        cp2k_output = os.path.join(self.cp2k_dir, self.cp2k_output)
+        wannier_atoms = io.read(os.path.join(self.cp2k_dir, self.wannier_file))
+        # frame 0: atoms and wannier centers translated by a non-lattice vector
+        shift = np.array([0.37, -1.21, 2.05])
+        shifted_sys = dpdata.LabeledSystem(cp2k_output, fmt="cp2k/output")
+        shifted_sys.data["coords"] += shift
+        shifted_wannier = wannier_atoms.copy()
+        shifted_wannier.translate(shift)
+        # frame 2: one wannier center removed, so the coordination check fails
+        broken_wannier = wannier_atoms.copy()
+        del broken_wannier[int(np.flatnonzero(broken_wannier.symbols == "X")[0])]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            wannier_file = os.path.join(tmp_dir, "wannier.xyz")
+            io.write(wannier_file, shifted_wannier)
+            ref_sys = set_dplr_ext_from_cp2k_output(
+                shifted_sys.copy(), wannier_file, self.type_map, self.sel_type
+            )
+            io.write(wannier_file, broken_wannier)
+            broken_sys = set_dplr_ext_from_cp2k_output(
+                dpdata.LabeledSystem(cp2k_output, fmt="cp2k/output"),
+                wannier_file,
+                self.type_map,
+                self.sel_type,
+                export_atomic_weight=True,
+            )
+            # the leading frame is not aligned with dp_sys and must be skipped
+            io.write(
+                wannier_file,
+                [broken_wannier, shifted_wannier, wannier_atoms, broken_wannier],
+            )
+
+            for n_jobs in [1, 2]:
+                dp_sys = shifted_sys.copy()
+                dp_sys.append(dpdata.LabeledSystem(cp2k_output, fmt="cp2k/output"))
+                dp_sys.append(dpdata.LabeledSystem(cp2k_output, fmt="cp2k/output"))
+                dp_sys = set_dplr_ext_from_cp2k_output(
+                    dp_sys,
+                    wannier_file,
+                    self.type_map,
+                    self.sel_type,
+                    export_atomic_weight=True,
+                    n_jobs=n_jobs,
+                )
+
+                atomic_dipole = dp_sys.data["atomic_dipole"]
+                atomic_weight = dp_sys.data["atomic_weight"]
+                self.assertEqual(atomic_dipole.shape[0], 3)
+                np.testing.assert_allclose(
+                    atomic_dipole[0], ref_sys.data["atomic_dipole"][0]
+                )
+                np.testing.assert_allclose(
+                    atomic_dipole[1], self.data.data["atomic_dipole"][0]
+                )
+                np.testing.assert_allclose(
+                    atomic_dipole[2], broken_sys.data["atomic_dipole"][0]
+                )
+                np.testing.assert_array_equal(atomic_weight[:2], 1)
+                self.assertTrue(np.any(atomic_weight[2] == 0))
+                np.testing.assert_array_equal(
+                    atomic_weight[2], broken_sys.data["atomic_weight"][0]
+                )
+
+
+class TestReadCP2kOutput(unittest.TestCase, CP2kTestData):
+    def setUp(self):
+        CP2kTestData.__init__(self)
+
+    def test_cached_copy(self):
+        cp2k_output = os.path.join(self.cp2k_dir, self.cp2k_output)
+        dp_sys_1 = read_cp2k_output(cp2k_output)
+        dp_sys_1.data["coords"] += 1.0
+        dp_sys_2 = read_cp2k_output(cp2k_output)
+        expected = dpdata.LabeledSystem(cp2k_output, fmt="cp2k/output")
+        np.testing.assert_allclose(dp_sys_2.data["coords"], expected.data["coords"])
+
+
+class TestWannierNeighbors(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.cellpar = np.array([10.0, 12.0, 14.0, 90.0, 90.0, 90.0])
+        self.ref_coords = rng.uniform(-5.0, 20.0, (50, 3))
+        self.e_coords = rng.uniform(-5.0, 20.0, (400, 3))
+        self.cutoff = 2.0
+
+    def test_consistent_with_distance_array(self):
+        idx, mask = get_wannier_neighbors(
+            self.ref_coords, self.e_coords, self.cellpar, self.cutoff
+        )
+        dist_mat = distance_array(self.ref_coords, self.e_coords, box=self.cellpar)
+        for ii, dist_vec in enumerate(dist_mat):
+            np.testing.assert_array_equal(
+                idx[ii][mask[ii]], np.where(dist_vec < self.cutoff)[0]
+            )
+
+    def test_no_wannier_centers(self):
+        for cellpar in [self.cellpar, [10.0, 12.0, 14.0, 80.0, 95.0, 100.0]]:
+            idx, mask = get_wannier_neighbors(
+                self.ref_coords, np.empty((0, 3)), cellpar, self.cutoff
+            )
+            self.assertEqual(idx.shape, (len(self.ref_coords), 1))
+            self.assertFalse(np.any(mask))
+
+    @unittest.skipIf(
+        importlib.util.find_spec("numba") is None, "numba is not installed"
+    )
+    def test_numba(self):
+        for cellpar in [self.cellpar, [10.0, 12.0, 14.0, 80.0, 95.0, 100.0]]:
+            idx, mask = get_wannier_neighbors(
+                self.ref_coords, self.e_coords, cellpar, self.cutoff
+            )
+            with mock.patch.object(dplr, "NUMBA_PAIRS_THRESHOLD", 0):
+                idx_numba, mask_numba = get_wannier_neighbors(
+                    self.ref_coords, self.e_coords, cellpar, self.cutoff
+                )
+            np.testing.assert_array_equal(idx_numba, idx)
+            np.testing.assert_array_equal(mask_numba, mask)
+
+
 if __name__ == "__main__":
     unittest.main()